@@ -1,10 +1,10 @@
-import numpy as np
 import torch
 import torch.nn.functional as F
-from scipy.integrate import trapz
 from torch import nn
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
+from survival import expected_return_time, integration_grid
+
 
 class RMTPP(nn.Module):
     def __init__(self, cfg, global_cfg):
@@ -32,10 +32,12 @@ class RMTPP(nn.Module):
         if cfg.w_trainable:
             self.w = nn.Parameter(torch.FloatTensor([0.1]))
         else:
-            self.w = cfg.w
+            self.register_buffer('w', torch.tensor(cfg.w), persistent=False)
         self.time_scale = cfg.time_scale
         self.integration_end = cfg.integration_end
         self.prediction_start = global_cfg.prediction_start
+        self.register_buffer('_deltas', integration_grid(cfg.integration_end, global_cfg.activity_start, cfg.time_scale),
+                             persistent=False)
 
     def forward(self, cat_feats, num_feats, lengths):
         x = torch.zeros(*cat_feats.size()[:2], 0).to(cat_feats.device)
@@ -43,12 +45,12 @@ class RMTPP(nn.Module):
             x = torch.cat([x, emb(cat_feats[:, :, i])], axis=-1)
         x = torch.cat([x, num_feats], axis=-1)
         x = self.dropout(x)
-        x = pack_padded_sequence(x, lengths=lengths, batch_first=True, enforce_sorted=False)
+        x = pack_padded_sequence(x, lengths=lengths, batch_first=True, enforce_sorted=True)
         h_j, _ = self.rnn(x)
         h_j, lengths = pad_packed_sequence(h_j, batch_first=True)
         h_j = self.dropout(torch.tanh(self.hidden(h_j)))
 
-        o_j = self.output_dense(h_j).squeeze()
+        o_j = self.output_dense(h_j).squeeze(-1)
         ys_j = []
         for out in self.marker_outs:
             ys_j.append(out(h_j))
@@ -57,28 +59,17 @@ class RMTPP(nn.Module):
 
     def predict(self, o_j, t_j, lengths):
         with torch.no_grad():
-            batch_size = o_j.size(0)
-            last_o_j = o_j[torch.arange(batch_size), lengths - 1]
-            last_t_j = t_j[torch.arange(batch_size), lengths - 1]
-
-            t_til_start = (self.prediction_start - last_t_j) * self.time_scale
-            s_t_s = self._s_t(last_o_j, t_til_start)
-
-            preds = np.zeros(batch_size)
-            for i in range(batch_size):
-                ith_t_s, ith_s_t_s = t_til_start[i], s_t_s[i]
-                deltas = torch.arange(0,
-                                      (self.integration_end - last_t_j[i]) * self.time_scale,
-                                      self.time_scale).to(o_j.device)
-                ith_s_deltas = self._s_t(last_o_j[i], deltas[None, :])
-                pred_delta = trapz(ith_s_deltas[deltas < ith_t_s].cpu(),
-                                   deltas[deltas < ith_t_s].cpu())
-                pred_delta += trapz(ith_s_deltas[deltas >= ith_t_s].cpu(),
-                                    deltas[deltas >= ith_t_s].cpu()) / ith_s_t_s.item()
-                preds[i] = last_t_j[i].cpu().numpy() + pred_delta / self.time_scale
-        return preds
+            t_j = t_j.to(o_j.device)
+            last_idx = torch.as_tensor(lengths - 1, device=o_j.device).view(-1, 1)
+            last_o_j = o_j.gather(1, last_idx).squeeze(1)
+            last_t_j = t_j.gather(1, last_idx).squeeze(1)
+            preds = expected_return_time(last_o_j, last_t_j, self.w, self._deltas, self.time_scale,
+                                         self.prediction_start, self.integration_end)
+        return preds.cpu().numpy()
 
     def compute_loss(self, deltas, non_pad_mask, o_j, ys_j, ys_true):
+        # keep the exp terms in fp32 when the forward pass ran under autocast
+        o_j = o_j.float()
         deltas_scaled = deltas * self.time_scale
         p = o_j + self.w * deltas_scaled
         ll = (p + (torch.exp(o_j) - torch.exp(p)) / self.w) * non_pad_mask
@@ -93,8 +84,3 @@ class RMTPP(nn.Module):
                                                 reduction='sum')
 
         return (neg_ll + markers_loss) / torch.sum(non_pad_mask)
-
-    def _s_t(self, last_o_j, deltas):
-        out = torch.exp(torch.exp(last_o_j) / self.w - \
-                        torch.exp(last_o_j + self.w * deltas) / self.w)
-        return out.squeeze()
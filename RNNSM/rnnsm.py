@@ -1,9 +1,9 @@
-import numpy as np
 import torch
-from scipy.integrate import trapz
 from torch import nn
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
+from survival import expected_return_time, integration_grid
+
 
 class RNNSM(nn.Module):
     def __init__(self, cfg, global_cfg):
@@ -12,7 +12,8 @@ class RNNSM(nn.Module):
         self.lstm = nn.LSTM(cfg.input_size, cfg.lstm_hidden_size, batch_first=True)
         cat_sizes = cfg.cat_sizes
         emb_dims = cfg.emb_dims
-        self.embeddings = nn.ModuleList([nn.Embedding(cat_size + 1, emb_dim, padding_idx=global_cfg.padding) \
+        self.embeddings = nn.ModuleList([nn.Embedding(cat_size + 1, emb_dim, padding_idx=global_cfg.padding,
+                                                      sparse=cfg.get('sparse_embeddings', False)) \
                                          for cat_size, emb_dim in zip(cat_sizes, emb_dims)])
 
         total_emb_length = sum(emb_dims)
@@ -24,58 +25,52 @@ class RNNSM(nn.Module):
         if cfg.w_trainable:
             self.w = nn.Parameter(torch.FloatTensor([0.1]))
         else:
-            self.w = cfg.w
+            self.register_buffer('w', torch.tensor(cfg.w), persistent=False)
 
         self.time_scale = cfg.time_scale
         self.prediction_start = global_cfg.prediction_start
         self.integration_end = cfg.integration_end
+        self.register_buffer('_deltas', integration_grid(cfg.integration_end, global_cfg.activity_start, cfg.time_scale),
+                             persistent=False)
 
     def forward(self, cat_feats, num_feats, lengths):
-        x = torch.zeros((cat_feats.size(0), cat_feats.size(1), 0)).to(cat_feats.device)
-        for i, emb in enumerate(self.embeddings):
-            x = torch.cat([x, emb(cat_feats[:, :, i])], axis=-1)
-        x = torch.cat([x, num_feats], axis=-1)
+        embs = [emb(cat_feats[:, :, i]) for i, emb in enumerate(self.embeddings)]
+        x = torch.cat(embs + [num_feats], axis=-1)
         x = self.dropout(torch.tanh(self.input_dense(x)))
-        x = pack_padded_sequence(x, lengths=lengths, batch_first=True, enforce_sorted=False)
+        x = pack_padded_sequence(x, lengths=lengths, batch_first=True, enforce_sorted=True)
         h_j, _ = self.lstm(x)
         h_j, _ = pad_packed_sequence(h_j, batch_first=True)
         h_j = self.dropout(torch.tanh(self.hidden(h_j)))
-        o_j = self.output_dense(h_j).squeeze()
+        o_j = self.output_dense(h_j).squeeze(-1)
         return o_j
 
     def compute_loss(self, deltas, non_pad_mask, ret_mask, o_j):
-        deltas_scaled = deltas * self.time_scale
-        p = o_j + self.w * deltas_scaled
-        common_term = -(torch.exp(o_j) - torch.exp(p)) / self.w * non_pad_mask
-        common_term = common_term.sum() / (non_pad_mask).sum()
-        ret_term = (-p * ret_mask).sum() / ret_mask.sum()
+        # keep the exp terms in fp32 when the forward pass ran under autocast
+        o_j = o_j.float()
+        n_valid = non_pad_mask.sum().clamp_min(1)
+        n_ret = ret_mask.sum().clamp_min(1)
+
+        per_elem, p = _loss_terms(o_j, deltas, self.w, self.time_scale)
+        # masked_fill keeps the reductions fixed-shape; masked_select would sync on its output size
+        common_term = per_elem.masked_fill(~non_pad_mask, 0).sum() / n_valid
+        ret_term = -p.masked_fill(~ret_mask, 0).sum() / n_ret
         return common_term + ret_term
 
     def predict(self, o_j, t_j, lengths):
         with torch.no_grad():
-            batch_size = o_j.size(0)
-            last_o_j = o_j[torch.arange(batch_size), lengths - 1]
-            last_t_j = t_j[torch.arange(batch_size), lengths - 1]
+            t_j = t_j.to(o_j.device)
+            last_idx = torch.as_tensor(lengths - 1, device=o_j.device).view(-1, 1)
+            last_o_j = o_j.gather(1, last_idx).squeeze(1)
+            last_t_j = t_j.gather(1, last_idx).squeeze(1)
 
-            t_til_start = (self.prediction_start - last_t_j) * self.time_scale
-            s_t_s = self._s_t(last_o_j, t_til_start)
+            preds = expected_return_time(last_o_j, last_t_j, self.w, self._deltas, self.time_scale,
+                                         self.prediction_start, self.integration_end)
 
-            preds = np.zeros(batch_size)
-            for i in range(batch_size):
-                ith_t_s, ith_s_t_s = t_til_start[i], s_t_s[i]
-                deltas = torch.arange(0,
-                                      (self.integration_end - last_t_j[i]) * self.time_scale,
-                                      self.time_scale).to(o_j.device)
-                ith_s_deltas = self._s_t(last_o_j[i], deltas[None, :])
-                pred_delta = trapz(ith_s_deltas[deltas < ith_t_s].cpu(),
-                                   deltas[deltas < ith_t_s].cpu())
-                pred_delta += trapz(ith_s_deltas[deltas >= ith_t_s].cpu(),
-                                    deltas[deltas >= ith_t_s].cpu()) / ith_s_t_s.item()
-                preds[i] = last_t_j[i].cpu().numpy() + pred_delta / self.time_scale
+        return preds.cpu().numpy()
 
-        return preds
 
-    def _s_t(self, last_o_j, deltas):
-        out = torch.exp(torch.exp(last_o_j) / self.w - \
-                        torch.exp(last_o_j + self.w * deltas) / self.w)
-        return out.squeeze()
+@torch.jit.script
+def _loss_terms(o_j: torch.Tensor, deltas: torch.Tensor, w: torch.Tensor, time_scale: float):
+    w_deltas = w * (deltas * time_scale)
+    # -(exp(o) - exp(o + w*d)) / w == exp(o) / w * expm1(w*d)
+    return torch.exp(o_j) / w * torch.expm1(w_deltas), o_j + w_deltas
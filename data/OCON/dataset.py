@@ -1,3 +1,5 @@
+from functools import partial
+
 import numpy as np
 import pandas as pd
 import torch
@@ -101,21 +103,27 @@ class OconTrainDataset(Dataset):
         return len(self.timestamps)
 
 
-def pad_collate_train(batch, padding):
+def pad_collate_train(batch, padding, keep_timestamps=False):
+    batch = sorted(batch, key=lambda x: len(x[1]), reverse=True)
     (timestamps, cat_feats, num_feats, return_mask) = zip(*batch)
     lens = np.array([len(seq) for seq in cat_feats])
     timestamps_padded = pad_sequence(timestamps, batch_first=True, padding_value=0)
+    time_deltas = timestamps_padded[:, 1:] - timestamps_padded[:, :-1]
     cat_feats_padded = pad_sequence(cat_feats, batch_first=True, padding_value=0)
     num_feats_padded = pad_sequence(num_feats, batch_first=True, padding_value=0)
     return_mask = pad_sequence(return_mask, batch_first=True, padding_value=0)
     non_pad_mask = cat_feats_padded.ne(padding).squeeze()
 
-    return timestamps_padded, \
-           cat_feats_padded, \
-           num_feats_padded, \
-           non_pad_mask, \
-           return_mask, \
-           lens
+    padded = time_deltas, \
+             cat_feats_padded, \
+             num_feats_padded, \
+             non_pad_mask, \
+             return_mask, \
+             lens
+    # only models that consume absolute times get them, so they are not shipped to the device otherwise
+    if keep_timestamps:
+        return (timestamps_padded,) + padded
+    return padded
 
 
 class OconTestDataset(Dataset):
@@ -194,12 +202,13 @@ class OconTestDataset(Dataset):
 
 
 def pad_collate_test(batch):
+    batch = sorted(batch, key=lambda x: len(x[1]), reverse=True)
     (timestamps, cat_feats, num_feats, targets) = zip(*batch)
     lens = np.array([len(seq) for seq in timestamps])
     timestamps_padded = pad_sequence(timestamps, batch_first=True, padding_value=0)
     cat_feats_padded = pad_sequence(cat_feats, batch_first=True, padding_value=0)
     num_feats_padded = pad_sequence(num_feats, batch_first=True, padding_value=0)
-    targets = torch.FloatTensor(targets).squeeze()
+    targets = torch.FloatTensor(targets)
 
     return timestamps_padded, \
            cat_feats_padded, \
@@ -208,6 +217,47 @@ def pad_collate_test(batch):
            lens
 
 
+class DevicePreloadedLoader:
+    def __init__(self, dataset, collate_fn, batch_size, shuffle, drop_last, device):
+        *tensors, lens = collate_fn([dataset[i] for i in range(len(dataset))])
+        self.tensors = [t.to(device) for t in tensors]
+        self.lens = lens
+        # sequence fields are trimmed per batch to the batch max length plus their own offset
+        # (e.g. train timestamps hold one more event than the features)
+        self.offsets = [t.size(1) - lens.max() if t.dim() > 1 else None for t in tensors]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.device = device
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lens) // self.batch_size
+        return (len(self.lens) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.lens)
+        order = torch.randperm(n) if self.shuffle else torch.arange(n)
+        for i in range(len(self)):
+            idx = order[i * self.batch_size:(i + 1) * self.batch_size]
+            idx = idx[torch.from_numpy(np.argsort(-self.lens[idx.numpy()], kind='stable'))]
+            lens = self.lens[idx.numpy()]
+            dev_idx = idx.to(self.device)
+            batch = []
+            for t, offset in zip(self.tensors, self.offsets):
+                t = t.index_select(0, dev_idx)
+                if offset is not None:
+                    t = t[:, :lens.max() + offset]
+                batch.append(t)
+            yield (*batch, lens)
+
+
+def _worker_kwargs(num_workers, prefetch_factor):
+    if num_workers == 0:
+        return {}
+    return dict(num_workers=num_workers, persistent_workers=True, prefetch_factor=prefetch_factor)
+
+
 def get_ocon_train_val_loaders(model,
                                cat_feat_name,
                                num_feat_name,
@@ -216,7 +266,11 @@ def get_ocon_train_val_loaders(model,
                                batch_size=32,
                                max_seq_len=500,
                                train_ratio=0.7,
-                               seed=42):
+                               seed=42,
+                               pin_memory=False,
+                               num_workers=0,
+                               prefetch_factor=2,
+                               device=None):
     if path is None:
         filename = 'data/OCON/train.csv'
     else:
@@ -238,18 +292,39 @@ def get_ocon_train_val_loaders(model,
                                 global_cfg,
                                 include_last_event=model == 'rnnsm' or model == 'grobformer',
                                 max_seq_len=max_seq_len)
+    val_ds = OconTestDataset(val, cat_feat_name, num_feat_name, global_cfg, max_seq_len=max_seq_len)
+    collate_train = partial(pad_collate_train, padding=global_cfg.padding, keep_timestamps=model == 'grobformer')
+
+    if device is not None:
+        train_loader = DevicePreloadedLoader(train_ds,
+                                             collate_train,
+                                             batch_size=batch_size,
+                                             shuffle=True,
+                                             drop_last=True,
+                                             device=device)
+        val_loader = DevicePreloadedLoader(val_ds,
+                                           pad_collate_test,
+                                           batch_size=batch_size,
+                                           shuffle=False,
+                                           drop_last=False,
+                                           device=device)
+        return train_loader, val_loader
+
     train_loader = DataLoader(dataset=train_ds,
                               batch_size=batch_size,
                               shuffle=True,
-                              collate_fn=lambda x: pad_collate_train(x, global_cfg.padding),
-                              drop_last=True)
+                              collate_fn=collate_train,
+                              drop_last=True,
+                              pin_memory=pin_memory,
+                              **_worker_kwargs(num_workers, prefetch_factor))
 
-    val_ds = OconTestDataset(val, cat_feat_name, num_feat_name, global_cfg, max_seq_len=max_seq_len)
     val_loader = DataLoader(dataset=val_ds,
                             batch_size=batch_size,
                             shuffle=False,
                             collate_fn=pad_collate_test,
-                            drop_last=False)
+                            drop_last=False,
+                            pin_memory=pin_memory,
+                            **_worker_kwargs(num_workers, prefetch_factor))
 
     return train_loader, val_loader
 
@@ -259,7 +334,10 @@ def get_ocon_test_loader(cat_feat_name,
                          global_cfg,
                          path=None,
                          batch_size=32,
-                         max_seq_len=500):
+                         max_seq_len=500,
+                         pin_memory=False,
+                         num_workers=0,
+                         prefetch_factor=2):
     if path is None:
         filename = 'data/OCON/test.csv'
     else:
@@ -271,6 +349,8 @@ def get_ocon_test_loader(cat_feat_name,
                              batch_size=batch_size,
                              shuffle=False,
                              collate_fn=pad_collate_test,
-                             drop_last=False)
+                             drop_last=False,
+                             pin_memory=pin_memory,
+                             **_worker_kwargs(num_workers, prefetch_factor))
 
     return test_loader
@@ -4,6 +4,7 @@ from torch.nn.utils.rnn import pad_sequence
 
 from RNNSM.rnnsm import RNNSM
 from grobformer.transformer import Transformer
+from survival import integration_grid
 
 
 class Grobformer(RNNSM):
@@ -27,11 +28,13 @@ class Grobformer(RNNSM):
         if cfg.w_trainable:
             self.w = nn.Parameter(torch.FloatTensor([0.1]))
         else:
-            self.w = cfg.w
+            self.register_buffer('w', torch.tensor(cfg.w), persistent=False)
 
         self.time_scale = cfg.time_scale
         self.prediction_start = global_cfg.prediction_start
         self.integration_end = cfg.integration_end
+        self.register_buffer('_deltas', integration_grid(cfg.integration_end, global_cfg.activity_start, cfg.time_scale),
+                             persistent=False)
 
     def forward(self, cat_feats, times, lengths):
         # times = times * self.time_scale
@@ -41,5 +44,5 @@ class Grobformer(RNNSM):
         non_pad_mask = pad_sequence(
             [torch.ones(l).ne(0) for l in lengths], batch_first=True).to(cat_feats.device)
         hidden_states = self.transformer(cat_feats.squeeze(), times.squeeze(), non_pad_mask)
-        o_j = self.output_dense(hidden_states).squeeze()
+        o_j = self.output_dense(hidden_states).squeeze(-1)
         return o_j
@@ -0,0 +1,62 @@
+import numpy as np
+import torch
+from numba import njit, prange
+
+
+def integration_grid(integration_end, activity_start, time_scale):
+    # predictions are only made for sequences whose last event lies after activity_start,
+    # so no row integrates over more than integration_end - activity_start time units
+    n_steps = int(np.ceil(integration_end - activity_start))
+    return torch.arange(n_steps) * time_scale
+
+
+def expected_return_time(last_o_j, last_t_j, w, deltas, time_scale, prediction_start, integration_end):
+    t_til_start = (prediction_start - last_t_j) * time_scale
+    t_til_end = (integration_end - last_t_j) * time_scale
+
+    if last_o_j.device.type == 'cpu':
+        integral = torch.from_numpy(_integrate_batch(last_o_j.numpy(), float(w), deltas.numpy(),
+                                                     t_til_start.numpy(), t_til_end.numpy())).to(last_t_j.dtype)
+    else:
+        s_t_s = survival(last_o_j, t_til_start, w)
+        # one integration grid for the whole batch; each row is cut at its own integration end below
+        s_deltas = survival(last_o_j[:, None], deltas[None, :], w)
+        trapz_full = 0.5 * time_scale * (s_deltas[:, 1:] + s_deltas[:, :-1])
+
+        # segments lying fully before / after the prediction start, cut at each row's integration end
+        in_range = deltas[None, 1:] < t_til_end[:, None]
+        before_start = deltas[None, :] < t_til_start[:, None]
+        pre = trapz_full.masked_fill(~(before_start[:, 1:] & in_range), 0).sum(-1)
+        post = trapz_full.masked_fill(~(~before_start[:, :-1] & in_range), 0).sum(-1)
+        integral = pre + post / s_t_s
+    return last_t_j + integral / time_scale
+
+
+@torch.jit.script
+def survival(last_o_j: torch.Tensor, deltas: torch.Tensor, w: torch.Tensor) -> torch.Tensor:
+    # exp(o)/w - exp(o + w*d)/w == -exp(o)/w * expm1(w*d), scripted so the JIT fuser sees the whole chain
+    return torch.exp(-torch.exp(last_o_j) / w * torch.expm1(w * deltas))
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _integrate_batch(last_o_j, w, deltas, t_til_start, t_til_end):
+    batch_size, n_steps = last_o_j.shape[0], deltas.shape[0]
+    out = np.zeros(batch_size)
+    for i in prange(batch_size):
+        # same survival function as above, evaluated point by point along the row
+        scale = -np.exp(last_o_j[i]) / w
+        s_t_s = np.exp(scale * np.expm1(w * t_til_start[i]))
+        s_prev = np.exp(scale * np.expm1(w * deltas[0]))
+        pre, post = 0., 0.
+        for j in range(1, n_steps):
+            if deltas[j] >= t_til_end[i]:
+                break
+            s_cur = np.exp(scale * np.expm1(w * deltas[j]))
+            area = 0.5 * (deltas[j] - deltas[j - 1]) * (s_cur + s_prev)
+            if deltas[j] < t_til_start[i]:
+                pre += area
+            elif deltas[j - 1] >= t_til_start[i]:
+                post += area
+            s_prev = s_cur
+        out[i] = pre + post / s_t_s
+    return out
@@ -12,8 +12,8 @@ from utils import *
 
 
 def test(val_loader, model, global_cfg, device):
-    all_preds = []
-    all_targets = []
+    pred_list = []
+    target_list = []
 
     model2test_step = {RNNSM: rnnsm_test_step, RMTPP: rmtpp_test_step, \
                        Grobformer: grobformer_test_step}
@@ -22,19 +22,16 @@ def test(val_loader, model, global_cfg, device):
     model.eval()
     with torch.no_grad():
         for batch in val_loader:
-            preds = test_step(model, device, *batch)
-            targets = batch[-2]
-            targets = targets.numpy()
+            pred_list.append(test_step(model, device, *batch))
+            target_list.append(batch[-2])
 
-            all_preds.extend(preds.tolist())
-            all_targets.extend(targets.tolist())
-
-    all_preds = np.array(all_preds)
-    all_targets = np.array(all_targets)
+    all_preds = np.concatenate(pred_list)
+    all_targets = torch.cat(target_list).cpu().numpy()
+    rmse, recall, auc = calc_metrics(all_preds, all_targets, global_cfg.prediction_end)
     print(f'Testing: '
-          f'RMSE: {calc_rmse(all_preds, all_targets)},\t'
-          f'Recall: {calc_recall(all_preds, all_targets, global_cfg.prediction_end)},\t'
-          f'AUC: {calc_auc(all_preds, all_targets, global_cfg.prediction_end)}')
+          f'RMSE: {rmse},\t'
+          f'Recall: {recall},\t'
+          f'AUC: {auc}')
 
 
 def main():
@@ -57,10 +54,14 @@ def main():
                                        global_cfg=cfg.globals,
                                        path='data/OCON/test.csv',
                                        batch_size=cfg.training.batch_size,
-                                       max_seq_len=model_cfg.max_seq_len)
+                                       max_seq_len=model_cfg.max_seq_len,
+                                       pin_memory=device.type == 'cuda',
+                                       num_workers=cfg.training.num_workers,
+                                       prefetch_factor=cfg.training.prefetch_factor)
 
     model = model_class(model_cfg, cfg.globals)
-    model.load_state_dict(torch.load(cfg.testing.model_path))
+    model.load_state_dict(torch.load(cfg.testing.model_path, map_location=device))
+    model = model.to(device)
     test(test_loader, model, cfg.globals, device)
 
 
@@ -13,9 +13,45 @@ import numpy as np
 from utils import *
 
 
+class CUDAPrefetcher:
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self._iter = iter(self.loader)
+        self._preload()
+        return self
+
+    def __next__(self):
+        torch.cuda.current_stream(self.device).wait_stream(self.stream)
+        batch = self._next_batch
+        if batch is None:
+            raise StopIteration
+        for x in batch:
+            if isinstance(x, torch.Tensor):
+                x.record_stream(torch.cuda.current_stream(self.device))
+        self._preload()
+        return batch
+
+    def _preload(self):
+        try:
+            batch = next(self._iter)
+        except StopIteration:
+            self._next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self._next_batch = [x.to(self.device, non_blocking=True) if isinstance(x, torch.Tensor) else x
+                                for x in batch]
+
+
 def validate(val_loader, model, prediction_start, prediction_end, device):
-    all_preds = []
-    all_targets = []
+    pred_list = []
+    target_list = []
 
     model2test_step = {RNNSM: rnnsm_test_step, RMTPP: rmtpp_test_step, \
                         Grobformer: grobformer_test_step}
@@ -23,42 +59,43 @@ def validate(val_loader, model, prediction_start, prediction_end, device):
 
     with torch.no_grad():
         for batch in val_loader:
-            preds = test_step(model, device, *batch)
-            targets = batch[-2]
-            targets = targets.numpy()
+            pred_list.append(test_step(model, device, *batch))
+            target_list.append(batch[-2])
 
-            all_preds.extend(preds.tolist())
-            all_targets.extend(targets.tolist())
+    all_preds = np.concatenate(pred_list)
+    all_targets = torch.cat(target_list).cpu().numpy()
+    return calc_metrics(all_preds, all_targets, prediction_end)
 
-    all_preds = np.array(all_preds)
-    all_targets = np.array(all_targets)
-    return calc_rmse(all_preds, all_targets), \
-        calc_recall(all_preds, all_targets, prediction_end), \
-        calc_auc(all_preds, all_targets, prediction_end)
 
+def to_device(device, *tensors):
+    return [t.to(device, non_blocking=True) for t in tensors]
 
-def rnnsm_train_step(model, device, timestamps, cat_feats, num_feats, non_pad_mask, return_mask, lengths):
-    deltas = timestamps[:, 1:] - timestamps[:, :-1]
-    o_j = model(cat_feats.to(device), num_feats.to(device), lengths)
+
+def rnnsm_train_step(model, device, deltas, cat_feats, num_feats, non_pad_mask, return_mask, lengths):
+    deltas, cat_feats, num_feats, non_pad_mask, return_mask = \
+        to_device(device, deltas, cat_feats, num_feats, non_pad_mask, return_mask)
+    o_j = model(cat_feats, num_feats, lengths)
     loss = model.compute_loss(deltas, non_pad_mask, return_mask, o_j)
     return loss
 
 
-def rmtpp_train_step(model, device, timestamps, cat_feats, num_feats, non_pad_mask, return_mask, lengths):
-    deltas = timestamps[:, 1:] - timestamps[:, :-1]
-    o_j, y_j = model(cat_feats.to(device), num_feats.to(device), lengths)
+def rmtpp_train_step(model, device, deltas, cat_feats, num_feats, non_pad_mask, return_mask, lengths):
+    deltas, cat_feats, num_feats, non_pad_mask = \
+        to_device(device, deltas, cat_feats, num_feats, non_pad_mask)
+    o_j, y_j = model(cat_feats, num_feats, lengths)
     loss = model.compute_loss(deltas, non_pad_mask, o_j, y_j, cat_feats)
     return loss
 
 
-def grobformer_train_step(model, device, timestamps, cat_feats, num_feats, non_pad_mask, return_mask, lengths):
-    deltas = timestamps[:, 1:] - timestamps[:, :-1]
-    o_j = model(cat_feats.to(device), timestamps.to(device), lengths)
+def grobformer_train_step(model, device, timestamps, deltas, cat_feats, num_feats, non_pad_mask, return_mask, lengths):
+    timestamps, deltas, cat_feats, non_pad_mask, return_mask = \
+        to_device(device, timestamps, deltas, cat_feats, non_pad_mask, return_mask)
+    o_j = model(cat_feats, timestamps, lengths)
     loss = model.compute_loss(deltas, non_pad_mask, return_mask, o_j)
     return loss
 
 
-def train(train_loader, val_loader, model, optimizer, train_cfg, global_cfg, device):
+def train(train_loader, val_loader, model, optimizers, train_cfg, global_cfg, device):
     train_metrics = defaultdict(list)
     val_metrics = defaultdict(list)
 
@@ -67,21 +104,29 @@ def train(train_loader, val_loader, model, optimizer, train_cfg, global_cfg, dev
     train_step = model2train_step[type(model)]
 
     best_metric = 1e10 if train_cfg.validate_by == 'rmse' else -1
+    use_amp = train_cfg.amp and device.type == 'cuda'
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
 
     for epoch in range(train_cfg.n_epochs):
         print(f'Epoch {epoch+1}/{train_cfg.n_epochs}....')
-        losses = []
+        running_loss = torch.zeros((), device=device)
+        n_batches = 0
         model.train()
 
         for batch in train_loader:
-            loss = train_step(model, device, *batch)
-
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-            losses.append(loss.item())
-
-        train_metrics['loss'].append(np.mean(losses))
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                loss = train_step(model, device, *batch)
+
+            for optimizer in optimizers:
+                optimizer.zero_grad(set_to_none=True)
+            scaler.scale(loss).backward()
+            for optimizer in optimizers:
+                scaler.step(optimizer)
+            scaler.update()
+            running_loss += loss.detach()
+            n_batches += 1
+
+        train_metrics['loss'].append((running_loss / n_batches).item())
         print("Loss:", train_metrics['loss'][-1])
 
         model.eval()
@@ -138,11 +183,25 @@ def main():
                                  global_cfg=cfg.globals,
                                  path='data/OCON/train.csv',
                                  batch_size=cfg.training.batch_size,
-                                 max_seq_len=model_cfg.max_seq_len)
+                                 max_seq_len=model_cfg.max_seq_len,
+                                 pin_memory=device.type == 'cuda',
+                                 num_workers=cfg.training.num_workers,
+                                 prefetch_factor=cfg.training.prefetch_factor,
+                                 device=device if cfg.training.preload_to_device else None)
+
+    if device.type == 'cuda' and not cfg.training.preload_to_device:
+        train_loader = CUDAPrefetcher(train_loader, device)
+        val_loader = CUDAPrefetcher(val_loader, device)
 
     model = model_class(model_cfg, cfg.globals).to(device)
-    optimizer = optim.Adam(model.parameters(), lr=cfg.training.lr)
-    train(train_loader, val_loader, model, optimizer, cfg.training, cfg.globals, device)
+    if model_cfg.get('sparse_embeddings', False):
+        emb_params = list(model.embeddings.parameters())
+        dense_params = [p for name, p in model.named_parameters() if not name.startswith('embeddings.')]
+        optimizers = [optim.Adam(dense_params, lr=cfg.training.lr),
+                      optim.SparseAdam(emb_params, lr=cfg.training.lr)]
+    else:
+        optimizers = [optim.Adam(model.parameters(), lr=cfg.training.lr)]
+    train(train_loader, val_loader, model, optimizers, cfg.training, cfg.globals, device)
 
 
 if __name__ == '__main__':